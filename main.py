@@ -1,12 +1,56 @@
-import json
-from openai import OpenAI
-from tenacity import retry, wait_random_exponential, stop_after_attempt
-from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import Literal
+import asyncio
+import contextvars
+import email.message
+import functools
+import hashlib
+import httpx
+import logging
+import os
+import queue
+import random
+from cachetools import Cache, LRUCache, TTLCache
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+from openai import (
+    NOT_GIVEN,
+    APIConnectionError,
+    APIError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+)
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from typing import Literal, Optional
 from braintrust import init_logger, wrap_openai
 
 GPT_MODEL = "gpt-4o"
+CACHE_SIZE = 4096
+LOCAL_CACHE_SIZE = 1024
+LOCAL_CACHE_TTL = 300
+REDIS_CACHE_TTL = 86400
+REDIS_KEY_PREFIX = "wo:"
+REDIS_TIMEOUT = 0.25
+WEIGHT_BUCKET_KG = 2.5
+HEIGHT_BUCKET_CM = 2.5
+MAX_ATTEMPTS = 3
+MAX_CONCURRENT_RETRIES = 8
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MAX = 10.0
+BACKOFF_BASE = 0.5
+MAX_BACKOFF = 20.0
+RETRYABLE_ERRORS = (
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError,
+    # Raised unwrapped by the SDK when a stream breaks after the response starts.
+    httpx.TransportError,
+)
 
 TOOLS = [
     {
@@ -14,7 +58,7 @@ TOOLS = [
         "function": {
             "name": "get_workout_program",
             "description": "Generate a workout program based on user data",
-            "strict": False,
+            "strict": True,
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -40,15 +84,29 @@ TOOLS = [
                                 "sets": {"type": "integer"},
                                 "reps": {"type": "integer"},
                             },
+                            "required": [
+                                "activityName",
+                                "description",
+                                "day",
+                                "sets",
+                                "reps",
+                            ],
+                            "additionalProperties": False,
                         },
                     }
                 },
-                "required": ["activityName", "description", "day"],
+                "required": ["activities"],
+                "additionalProperties": False,
             },
         },
     }
 ]
 
+TOOL_CHOICE = {"type": "function", "function": {"name": "get_workout_program"}}
+
+# SYSTEM_PROMPT, TOOLS and TOOL_CHOICE are sent as the leading, unchanging prefix
+# of every request so OpenAI's automatic prompt caching can reuse them. Never
+# interpolate per-request data into any of them, or mutate SYSTEM_MSG or FEWSHOT.
 SYSTEM_PROMPT = """
 Create a system to analyze user exercise history, and generate a customized weekly exercise plan that aims to improve the user's specific activity. 
 
@@ -65,17 +123,42 @@ Understand the user's goal for improvement in the specific activity (e.g., incre
 - Always name specific exercises the user must perform (e.g. "bicep curls" instead of "upper body strength")
 - If the user is interested in Weight Training, create a plan where each day hits a specific body part. E.g. arms, legs, back, etc.  
 
-** Example input: **
+*Height will always be given in centimeters, and weight is always given in kilograms.* The user's exercise history is sent as JSON.
+
+### Exceptional cases:
 
-*Height will always be given in centimeters, and weight is always given in kilograms.*
+For rest days, put the number of sets and reps as 1:
 
-```python
-sex='Male' weight=77.564232 height=182.88 experienceLevelMap=ExperienceLevelMap(weight_training='Intermediate', cycling='No Interest', running='Beginner')
+```json
+{
+  "activityName": "Active Rest",
+  "description": "Active rest, or active recovery, should get your blood flowing without being too strenuous.",
+  "day": "Sunday",
+  "sets": 1,
+  "reps": 1
+}
 ```
 
-** Correct output: **
+For workouts like runs or cycling, follow this format: 
 
-```JSON
+```json
+{
+  "activityName": "8km Run",
+  "description": "A steady pace long-distance run to build endurance and stamina.",
+  "day": "Sunday",
+  "sets": 1,
+  "reps": 1
+}
+```
+
+Always include the distance you think matches the user's experience level.
+"""
+
+SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+
+EXAMPLE_INPUT_MALE = """{"sex":"Male","weight":77.564232,"height":182.88,"experienceLevelMap":{"weight_training":"Intermediate","cycling":"No Interest","running":"Beginner"}}"""
+
+EXAMPLE_OUTPUT_MALE = """
 {
   "activities": [
     {
@@ -143,29 +226,11 @@ sex='Male' weight=77.564232 height=182.88 experienceLevelMap=ExperienceLevelMap(
     }
   ]
 }
+"""
 
-```
-
-**Example input: ** 
-
-*Height will always be given in centimeters, and weight is always given in kilograms.*
-
-{
-    "sex": "Female",
-    "weight": 63.50288,
-    "height": 172.72,
-    "experienceLevelMap": {
-        "weight_training": "Beginner",
-        "cycling": "No Interest",
-        "running": "Intermediate"
-    }
-}
-
-sex='Female' weight=63.50288 height=172.88 experienceLevelMap=ExperienceLevelMap(weight_training='Beginner', cycling='No Interest', running='Intermediate')
-
-** Correct output: **
+EXAMPLE_INPUT_FEMALE = """{"sex":"Female","weight":63.50288,"height":172.72,"experienceLevelMap":{"weight_training":"Beginner","cycling":"No Interest","running":"Intermediate"}}"""
 
-```JSON
+EXAMPLE_OUTPUT_FEMALE = """
 {
   "activities": [
     {
@@ -240,40 +305,119 @@ sex='Female' weight=63.50288 height=172.88 experienceLevelMap=ExperienceLevelMap
     }
   ]
 }
-```
+"""
 
-### Exceptional cases:
+# Worked examples are sent as prior conversation turns after the system message,
+# shaped like real turns: the assistant answers with a get_workout_program call
+# whose arguments are compacted once at import to save input tokens.
+FEWSHOT = tuple(
+    message
+    for call_id, example_input, example_output in (
+        ("call_example_male", EXAMPLE_INPUT_MALE, EXAMPLE_OUTPUT_MALE),
+        ("call_example_female", EXAMPLE_INPUT_FEMALE, EXAMPLE_OUTPUT_FEMALE),
+    )
+    for message in (
+        {"role": "user", "content": example_input},
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": call_id,
+                    "type": "function",
+                    "function": {
+                        "name": "get_workout_program",
+                        "arguments": orjson.dumps(
+                            orjson.loads(example_output)
+                        ).decode(),
+                    },
+                }
+            ],
+        },
+        {
+            "role": "tool",
+            "tool_call_id": call_id,
+            "content": "Workout program saved.",
+        },
+    )
+)
 
-For rest days, put the number of sets and reps as 1:
+logger = init_logger(project="AI Trainer API")
+log = logging.getLogger(__name__)
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+# Records are written by a background thread so logging never blocks the event
+# loop on a slow stdout/stderr pipe.
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+log.addHandler(QueueHandler(log_queue))
+log.propagate = False
+# wrap_openai hides the SDK's AsyncStream behind a generator that never closes
+# it, so create_completion collects the HTTP responses opened on its behalf
+# here and closes them itself once each attempt is over.
+open_responses: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar(
+    "open_responses", default=None
+)
+
+
+async def track_response(response: httpx.Response):
+    responses = open_responses.get()
+    if responses is not None:
+        responses.append(response)
+
+
+# Keeps the SDK's connection-pool defaults but replaces its 10 minute read
+# timeout: deduplicated requests all wait on one completion, so a hung stream
+# would otherwise stall every one of them.
+http_client = DefaultAsyncHttpxClient(
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    event_hooks={"response": [track_response]},
+)
+client = wrap_openai(AsyncOpenAI(max_retries=0, http_client=http_client))
+app = FastAPI(default_response_class=ORJSONResponse)
+# When REDIS_URL is set, workouts are cached in Redis so every worker shares
+# them, and a small short-lived local cache in front keeps the hot working set
+# off the network. Without Redis the local cache is the only one, so it is
+# larger and never expires entries.
+redis_client = (
+    Redis.from_url(
+        os.environ["REDIS_URL"],
+        socket_timeout=REDIS_TIMEOUT,
+        socket_connect_timeout=REDIS_TIMEOUT,
+    )
+    if "REDIS_URL" in os.environ
+    else None
+)
+activity_cache: Cache = (
+    TTLCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+    if redis_client is not None
+    else LRUCache(CACHE_SIZE)
+)
+inflight: dict[str, asyncio.Task] = {}
+retry_slots = asyncio.Semaphore(MAX_CONCURRENT_RETRIES)
 
-```json
-{
-  "activityName": "Active Rest",
-  "description": "Active rest, or active recovery, should get your blood flowing without being too strenuous.",
-  "day": "Sunday",
-  "sets": 1,
-  "reps": 1
-}
-```
 
-For workouts like runs or cycling, follow this format: 
+@app.on_event("startup")
+async def start_logging():
+    log_listener.start()
 
-```json
-{
-  "activityName": "8km Run",
-  "description": "A steady pace long-distance run to build endurance and stamina.",
-  "day": "Sunday",
-  "sets": 1,
-  "reps": 1
-}
-```
 
-Always include the distance you think matches the user's experience level.
-"""
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
 
-logger = init_logger(project="AI Trainer API")
-client = wrap_openai(OpenAI())
-app = FastAPI()
+
+@app.on_event("shutdown")
+async def close_redis_client():
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+@app.on_event("shutdown")
+async def stop_logging():
+    log_listener.stop()
 
 
 class ExperienceLevelMap(BaseModel):
@@ -289,35 +433,328 @@ class ExerciseHistory(BaseModel):
     experienceLevelMap: ExperienceLevelMap
 
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(messages, tools=None, tool_choice=None, model=GPT_MODEL):
+EXERCISE_HISTORY_ADAPTER = TypeAdapter(ExerciseHistory)
+
+
+def inline_json_schema(schema: dict) -> dict:
+    """Resolve ``$defs`` references so the schema can be embedded in OpenAPI."""
+    defs = schema.pop("$defs", {})
+
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(defs[node["$ref"].rsplit("/", 1)[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
+
+    return resolve(schema)
+
+
+def bucket(value: float, size: float) -> float:
+    return round(value / size) * size
+
+
+def cache_key(exerciseHistory: ExerciseHistory) -> str:
+    experienceLevelMap = {
+        activity: level.strip().lower()
+        for activity, level in exerciseHistory.experienceLevelMap.model_dump().items()
+    }
+    canonical = orjson.dumps(
+        {
+            "sex": exerciseHistory.sex,
+            "weight": bucket(exerciseHistory.weight, WEIGHT_BUCKET_KG),
+            "height": bucket(exerciseHistory.height, HEIGHT_BUCKET_CM),
+            "experienceLevelMap": experienceLevelMap,
+        },
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+class RetryBudget:
+    """Token bucket that only allows retries while most calls are succeeding.
+
+    Every success adds ``ratio`` tokens and every retry spends one, so during an
+    outage retries drain the bucket and stop instead of multiplying the load.
+    """
+
+    def __init__(self, ratio: float, maximum: float):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = maximum
+
+    def record_success(self):
+        self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def try_acquire(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+
+
+def requested_delay(error: Exception) -> Optional[float]:
+    if not isinstance(error, RateLimitError):
+        return None
+    headers = error.response.headers
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, ValueError):
+            pass
+    return None
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    delay = requested_delay(error)
+    if delay is not None:
+        return delay
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2**attempt))
+
+
+async def create_completion(**kwargs) -> str:
+    """Stream a completion and return the concatenated tool-call arguments.
+
+    Consuming the stream inside the retry loop, and reporting transport errors
+    and SSE error events as retryable, means a connection dropped mid-response
+    is retried like any other connection error.
+    """
+    responses = []
+    token = open_responses.set(responses)
+    stream = None
+    arguments = []
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            tools=tools,
-            tool_choice=tool_choice,
+        stream = await client.chat.completions.create(
+            **kwargs, stream=True, stream_options={"include_usage": True}
         )
+        async for chunk in stream:
+            if chunk.choices:
+                tool_calls = chunk.choices[0].delta.tool_calls
+                if tool_calls and tool_calls[0].function is not None:
+                    arguments.append(tool_calls[0].function.arguments or "")
+            usage = chunk.usage
+            if usage is not None and usage.prompt_tokens_details is not None:
+                log.info(
+                    "Prompt tokens: %d (cached: %d)",
+                    usage.prompt_tokens,
+                    usage.prompt_tokens_details.cached_tokens,
+                )
+    except APIError as e:
+        # Error events inside the stream are raised as a bare APIError.
+        if type(e) is APIError:
+            raise APIConnectionError(message=e.message, request=e.request) from e
+        raise
+    finally:
+        open_responses.reset(token)
+        # Closing wrap_openai's generator ends its tracing span; closing the
+        # response releases the pooled connection, even after a failed attempt.
+        if stream is not None and hasattr(stream, "aclose"):
+            await stream.aclose()
+        for response in responses:
+            await response.aclose()
+    return "".join(arguments)
+
+
+async def chat_completion_request(
+    messages, tools=None, tool_choice=None, model=GPT_MODEL
+):
+    kwargs = dict(
+        model=model,
+        messages=messages,
+        tools=tools,
+        tool_choice=tool_choice,
+        # Strict function schemas cannot be used with parallel tool calls.
+        parallel_tool_calls=False if tools else NOT_GIVEN,
+    )
+    try:
+        response = await create_completion(**kwargs)
+    except RETRYABLE_ERRORS as e:
+        error = e
+    else:
+        retry_budget.record_success()
+        return response
+
+    for attempt in range(1, MAX_ATTEMPTS):
+        delay = retry_delay(error, attempt)
+        # A retry the server asked us to hold off on for longer than we are
+        # willing to wait is doomed, so it is dropped like an over-budget one.
+        if delay > MAX_BACKOFF:
+            log.warning(
+                "Dropping ChatCompletion retry, server asked to wait %.1fs: %s",
+                delay,
+                error,
+            )
+            raise error
+        if retry_slots.locked() or not retry_budget.try_acquire():
+            log.warning("Dropping ChatCompletion retry under load: %s", error)
+            raise error
+        async with retry_slots:
+            await asyncio.sleep(delay)
+            try:
+                response = await create_completion(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                log.warning("ChatCompletion retry %d failed: %s", attempt, e)
+                error = e
+                continue
+        retry_budget.record_success()
         return response
-    except Exception as e:
-        print("Unable to generate ChatCompletion response")
-        print(f"Exception: {e}")
-        return e
-
-
-@app.post("/workout")
-async def generate_workout(exerciseHistory: ExerciseHistory):
-    messages = []
-    messages.append({"role": "system", "content": SYSTEM_PROMPT})
-    messages.append({"role": "user", "content": str(exerciseHistory)})
-    chat_response = chat_completion_request(
+    raise error
+
+
+async def get_shared_activities(key: str) -> Optional[list]:
+    if redis_client is None:
+        return None
+    try:
+        hit = await redis_client.get(REDIS_KEY_PREFIX + key)
+    except RedisError as e:
+        log.warning("Unable to read workout cache: %s", e)
+        return None
+    if hit is None:
+        return None
+    try:
+        activities = orjson.loads(hit)
+    except orjson.JSONDecodeError:
+        activities = None
+    if not isinstance(activities, list):
+        log.warning("Ignoring corrupt workout cache entry %s", key)
+        return None
+    activity_cache[key] = activities
+    return activities
+
+
+async def set_shared_activities(key: str, activities: list):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.set(
+            REDIS_KEY_PREFIX + key, orjson.dumps(activities), ex=REDIS_CACHE_TTL
+        )
+    except RedisError as e:
+        log.warning("Unable to write workout cache: %s", e)
+
+
+async def generate_activities(exerciseHistory: ExerciseHistory) -> list:
+    messages = [
+        SYSTEM_MSG,
+        *FEWSHOT,
+        {"role": "user", "content": exerciseHistory.model_dump_json()},
+    ]
+    arguments = await chat_completion_request(
         messages,
         tools=TOOLS,
-        tool_choice={"type": "function", "function": {"name": "get_workout_program"}},
+        tool_choice=TOOL_CHOICE,
     )
 
-    activities = json.loads(
-        chat_response.choices[0].message.tool_calls[0].function.arguments
+    try:
+        activities = orjson.loads(arguments)
+    except orjson.JSONDecodeError:
+        activities = None
+    if not isinstance(activities, dict) or not isinstance(
+        activities.get("activities"), list
+    ):
+        log.warning("Model returned malformed tool arguments: %r", arguments)
+        raise HTTPException(status_code=502, detail="Malformed model response")
+    return activities["activities"]
+
+
+async def generate_shared_activities(
+    key: str, exerciseHistory: ExerciseHistory
+) -> list:
+    activities = await generate_activities(exerciseHistory)
+    await set_shared_activities(key, activities)
+    return activities
+
+
+def finish_generation(key: str, task: asyncio.Task):
+    del inflight[key]
+    # Retrieving the exception also keeps asyncio from logging it as unhandled
+    # when every waiter has already gone away.
+    if task.cancelled() or task.exception() is not None:
+        return
+    activity_cache[key] = task.result()
+
+
+def is_json_content_type(content_type: Optional[str]) -> bool:
+    # Same rule FastAPI applies to body parameters: a missing Content-Type is
+    # treated as JSON, otherwise it must be application/json or application/*+json.
+    if not content_type:
+        return True
+    message = email.message.Message()
+    message["content-type"] = content_type
+    subtype = message.get_content_subtype()
+    return message.get_content_maintype() == "application" and (
+        subtype == "json" or subtype.endswith("+json")
     )
 
-    return activities["activities"]
+
+def body_error(error: dict) -> dict:
+    error = {**error, "loc": ("body", *error["loc"])}
+    # For unparseable JSON pydantic reports the raw body bytes as the input,
+    # which FastAPI cannot encode if they are not valid UTF-8.
+    if error["type"] == "json_invalid":
+        error["input"] = {}
+    return error
+
+
+# The body is read and validated by hand, so its schema is declared here to keep
+# it in /openapi.json.
+@app.post(
+    "/workout",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": inline_json_schema(ExerciseHistory.model_json_schema())
+                }
+            },
+        }
+    },
+)
+async def generate_workout(request: Request):
+    if not is_json_content_type(request.headers.get("content-type")):
+        raise RequestValidationError(
+            [
+                {
+                    "type": "model_attributes_type",
+                    "loc": ("body",),
+                    "msg": "Input should be a valid dictionary or object to extract "
+                    "fields from",
+                    "input": {},
+                }
+            ]
+        )
+    try:
+        exerciseHistory = EXERCISE_HISTORY_ADAPTER.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [body_error(error) for error in e.errors(include_url=False)]
+        )
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Exercise history: %s", exerciseHistory.model_dump())
+
+    key = cache_key(exerciseHistory)
+    cached = activity_cache.get(key)
+    if cached is None:
+        cached = await get_shared_activities(key)
+    # Cached lists are already-decoded trusted data, so they are handed straight
+    # to orjson instead of going through FastAPI's jsonable_encoder walk.
+    if cached is not None:
+        return ORJSONResponse(cached)
+
+    # Identical requests that arrive while a completion is pending share one
+    # detached task instead of each calling OpenAI. Every caller awaits it
+    # through shield, so a disconnecting client never cancels it for the rest.
+    # The check and insert below run without an await in between, so no lock
+    # is needed.
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_shared_activities(key, exerciseHistory))
+        inflight[key] = task
+        task.add_done_callback(functools.partial(finish_generation, key))
+    return ORJSONResponse(await asyncio.shield(task))